@@ -1,12 +1,25 @@
-from flask import Flask, send_from_directory, request, jsonify, session, redirect
+from flask import Flask, Response, g, send_from_directory, request, jsonify, session, redirect
+from flask.json.provider import DefaultJSONProvider
+from flask_session import Session
+from whitenoise import WhiteNoise
 import os
+import atexit
+import heapq
 import json
+import queue
+import threading
 import time
 import secrets
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import Optional
-from werkzeug.security import check_password_hash, generate_password_hash
-import random
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 import string
+import orjson
+import redis
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -16,6 +29,29 @@ app = Flask(
     static_url_path=''
 )
 
+class OrjsonJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson; used by jsonify() and request.get_json()."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app.json = OrjsonJSONProvider(app)
+
+# Serve image assets from the WSGI layer (file metadata cached at startup,
+# sendfile where available). Only image/ is handed over: BASE_DIR also holds
+# app.py and the JSON stores, and market.html must keep its session gate.
+app.wsgi_app = WhiteNoise(
+    app.wsgi_app,
+    root=os.path.join(BASE_DIR, 'image'),
+    prefix='image',
+    autorefresh=False,
+    max_age=3600,
+)
+
 # Required for server-side sessions (protects against localStorage tampering)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'dev-secret-key-change-me')
 
@@ -24,70 +60,432 @@ DATA_FILE = os.path.join(BASE_DIR, 'data.json')
 # Storage format: list of { "email": str, "pass": str (hashed) }
 DEFAULT_LIST: list[dict] = []
 
+# Optional Redis user store. When REDIS_URL is set, users live in hashes
+# keyed "user:<email>" and data.json is only read once to migrate them.
+REDIS_URL = os.environ.get('REDIS_URL', '')
+_redis: Optional[redis.Redis] = (
+    redis.Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+)
+USER_CODES_KEY = 'users:codes'
+USERS_MIGRATED_KEY = 'users:migrated'
+USERS_VERSION_KEY = 'users:version'
+_USER_BOOL_FIELDS = ('email_changed', 'name_changed', 'google')
+
+# data.json index: kept in sync on every mutation and rebuilt whenever the
+# parsed file changes underneath it ("source" is the list it was built from)
+USERS_BY_EMAIL: dict[str, dict] = {}
+USER_CODES: set[str] = set()
+_USERS_INDEX = {"source": None, "generation": 0}
+
+# With Redis, keep sessions server-side so logout/invalidation is immediate.
+# Flask-Session stores serialized bytes, hence a client without decode_responses.
+if REDIS_URL:
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis.Redis.from_url(REDIS_URL)
+    Session(app)
+
+
+# Parsed JSON files keyed by path: {"stat": (st_ino, st_mtime_ns, st_size), "data": list}.
+# Writes atomically replace the file (new inode), so a write from this or
+# another worker always changes the key and the file is re-parsed on next read.
+_JSON_CACHE: dict[str, dict] = {}
+# 1 MiB I/O buffer so typical files take one read()/write() syscall
+_IO_BUFFER_SIZE = 1024 * 1024
+# Guards the JSON files and _JSON_CACHE for readers and writers alike
+_FILE_LOCK = threading.RLock()
+
+
+def _stat_key(path: str) -> Optional[tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _read_json_list(path: str) -> list[dict]:
+    with _FILE_LOCK:
+        # One stat() gives both the cache key and the empty-file check
+        key = _stat_key(path)
+        cached = _JSON_CACHE.get(path)
+        if cached is not None and cached['stat'] == key:
+            return cached['data']
+        data = []
+        if key is not None and key[2]:
+            try:
+                with open(path, 'rb', buffering=_IO_BUFFER_SIZE) as f:
+                    loaded = orjson.loads(f.read())
+            except Exception:
+                # Never cache a failed parse: keep the last good data and retry next read
+                return cached['data'] if cached is not None else []
+            data = loaded if isinstance(loaded, list) else []
+        _JSON_CACHE[path] = {"stat": key, "data": data}
+        return data
+
 
 def _read_users_list() -> list[dict]:
+    return _read_json_list(DATA_FILE)
+
+
+# Grouped writes: inside a buffered block, a thread's writes to a JSON file
+# are held back and the file is written once, with the latest cached data,
+# when that thread's outermost block exits. Other threads write as usual.
+_BUFFERS = threading.local()
+
+
+def _buffer_state() -> tuple[dict[str, int], set[str]]:
+    """Per-thread (nesting depth by path, paths with a deferred write)."""
+    if not hasattr(_BUFFERS, 'depth'):
+        _BUFFERS.depth = {}
+        _BUFFERS.pending = set()
+    return _BUFFERS.depth, _BUFFERS.pending
+
+
+def _write_json_list(path: str, data: list[dict]):
+    depth, pending = _buffer_state()
+    if depth.get(path):
+        with _FILE_LOCK:
+            # Reads see the new data right away, even while the write is deferred.
+            # Stamped with the current stat, which also covers a file that could
+            # not be parsed and so was never cached.
+            _JSON_CACHE[path] = {"stat": _stat_key(path), "data": data}
+        pending.add(path)
+        return
+    # Serialize up front so the file gets a single write() call
+    buf = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    # Write a sibling temp file and swap it in, so the file is never partial
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with _FILE_LOCK:
+        with open(tmp, 'wb', buffering=_IO_BUFFER_SIZE) as f:
+            f.write(buf)
+        os.replace(tmp, path)
+        _JSON_CACHE[path] = {"stat": _stat_key(path), "data": data}
+
+
+@contextmanager
+def _buffered_writes(path: str):
+    depth, pending = _buffer_state()
+    depth[path] = depth.get(path, 0) + 1
     try:
-        if not os.path.exists(DATA_FILE) or os.path.getsize(DATA_FILE) == 0:
-            return []
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data if isinstance(data, list) else []
-    except Exception:
-        return []
+        yield
+    finally:
+        depth[path] -= 1
+        if not depth[path] and path in pending:
+            pending.discard(path)
+            # Latest data for the file, including writes other threads made since
+            with _FILE_LOCK:
+                data = _JSON_CACHE[path]['data']
+            _write_json_list(path, data)
+
+
+def buffered_users():
+    """Defer data.json writes until the block (or decorated view) exits."""
+    return _buffered_writes(DATA_FILE)
 
 
 def _write_users_list(users: list[dict]):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
+    _write_json_list(DATA_FILE, users)
+
+
+def _user_key(email: str) -> str:
+    return f'user:{email}'
+
+
+def _user_to_hash(user: dict) -> dict[str, str]:
+    """Flatten a user dict into Redis hash fields (None values are skipped)."""
+    fields = {}
+    for k, v in user.items():
+        if v is None:
+            continue
+        if isinstance(v, bool):
+            v = '1' if v else '0'
+        fields[k] = str(v)
+    return fields
+
+
+def _user_from_hash(fields: dict[str, str]) -> Optional[dict]:
+    if not fields:
+        return None
+    user = dict(fields)
+    for k in _USER_BOOL_FIELDS:
+        if k in user:
+            user[k] = user[k] == '1'
+    return user
+
+
+def _find_user(email: str) -> Optional[dict]:
+    if _redis is not None:
+        return _user_from_hash(_redis.hgetall(_user_key(email)))
+    with _FILE_LOCK:
+        return _users_index().get(email)
+
+
+def _find_users(*emails: str) -> list[Optional[dict]]:
+    """Look up several users with one index sync (or one Redis round trip)."""
+    if _redis is not None:
+        pipe = _redis.pipeline(transaction=False)
+        for email in emails:
+            pipe.hgetall(_user_key(email))
+        return [_user_from_hash(fields) for fields in pipe.execute()]
+    with _FILE_LOCK:
+        users = _users_index()
+        return [users.get(email) for email in emails]
+
+
+def _user_exists(email: str) -> bool:
+    if _redis is not None:
+        return bool(_redis.exists(_user_key(email)))
+    with _FILE_LOCK:
+        return email in _users_index()
+
+
+def _save_user(user: dict, old_email: Optional[str] = None):
+    """Persist a user record. Pass old_email when the email itself changed."""
+    if _redis is not None:
+        pipe = _redis.pipeline()
+        if old_email and old_email != user.get('email'):
+            pipe.delete(_user_key(old_email))
+        pipe.hset(_user_key(user['email']), mapping=_user_to_hash(user))
+        if user.get('code'):
+            pipe.sadd(USER_CODES_KEY, user['code'])
+        pipe.incr(USERS_VERSION_KEY)
+        pipe.execute()
+        return
+    with _FILE_LOCK:
+        _index_user(user, old_email)
+        _flush_users()
+
+
+def _index_user(user: dict, old_email: Optional[str] = None):
+    with _FILE_LOCK:
+        # Sync first so a pending re-index can't drop this user afterwards
+        _users_index()
+        if old_email and old_email != user.get('email'):
+            USERS_BY_EMAIL.pop(old_email, None)
+        USERS_BY_EMAIL[user['email']] = user
+        if user.get('code'):
+            USER_CODES.add(user['code'])
+        _USERS_INDEX['generation'] += 1
+
+
+def _flush_users():
+    # Snapshot, source and cache change together, so _users_index never sees
+    # the new source next to the old cached list and re-indexes from it
+    with _FILE_LOCK:
+        users = list(USERS_BY_EMAIL.values())
+        _USERS_INDEX['source'] = users
+        _write_users_list(users)
 
 
-def _find_user(users: list[dict], email: str) -> Optional[dict]:
-    for u in users:
-        if isinstance(u, dict) and u.get('email') == email:
-            return u
-    return None
+# Non-critical updates made during login (code backfill, hash upgrade) are
+# applied to the index right away and written to data.json by a background
+# thread, coalesced to at most one write per _USERS_FLUSH_INTERVAL seconds.
+# Anything still unwritten at shutdown is flushed by an atexit hook.
+_USERS_FLUSH_INTERVAL = 2.0
+_USERS_FLUSH_QUEUE: queue.Queue = queue.Queue()
+# Set while the index holds changes not yet written; the flush lock keeps the
+# atexit hook from racing a flush that is already in progress.
+_USERS_DIRTY = threading.Event()
+_USERS_FLUSH_LOCK = threading.Lock()
+
+
+def _flush_dirty_users():
+    # _FILE_LOCK keeps request threads from changing the index mid-flush
+    with _USERS_FLUSH_LOCK, _FILE_LOCK:
+        if not _USERS_DIRTY.is_set():
+            return
+        _USERS_DIRTY.clear()
+        try:
+            _flush_users()
+        except Exception:
+            _USERS_DIRTY.set()
+            raise
 
 
+def _users_flush_worker():
+    while True:
+        _USERS_FLUSH_QUEUE.get()
+        time.sleep(_USERS_FLUSH_INTERVAL)
+        # Everything queued while sleeping is covered by this one write
+        while True:
+            try:
+                _USERS_FLUSH_QUEUE.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            _flush_dirty_users()
+        except Exception:
+            pass
+
+
+def _save_user_later(user: dict):
+    """Like _save_user, but leaves the data.json write to the flush thread."""
+    if _redis is not None:
+        _save_user(user)
+        return
+    with _FILE_LOCK:
+        _index_user(user)
+        _USERS_DIRTY.set()
+    _USERS_FLUSH_QUEUE.put(user['email'])
+
+
+
+def _users_version() -> int:
+    """Number that changes whenever any user record changes."""
+    if _redis is not None:
+        return int(_redis.get(USERS_VERSION_KEY) or 0)
+    with _FILE_LOCK:
+        _users_index()
+        return _USERS_INDEX['generation']
+
+
+def _reserve_code(code: str) -> bool:
+    """Claim code for a user. Returns False if it is already taken."""
+    if _redis is not None:
+        # SADD is atomic, so two workers can never hand out the same code
+        return bool(_redis.sadd(USER_CODES_KEY, code))
+    with _FILE_LOCK:
+        _users_index()
+        if code in USER_CODES:
+            return False
+        USER_CODES.add(code)
+        return True
+
+
+_CODE_LETTERS = string.ascii_letters
+_CODE_ALPHABET = string.ascii_letters + string.digits
 
-def _generate_unique_code(existing: set[str], length: int = 7) -> str:
-    alphabet = string.ascii_letters + string.digits
+
+def _random_code(length: int = 7) -> str:
     # Ensure first char is a letter to match sample like Ez34Als
+    return secrets.choice(_CODE_LETTERS) + ''.join(
+        secrets.choice(_CODE_ALPHABET) for _ in range(length - 1))
+
+
+def _generate_unique_code(length: int = 7) -> str:
     while True:
-        first = random.choice(string.ascii_letters)
-        rest = ''.join(random.choice(alphabet) for _ in range(length - 1))
-        code = first + rest
-        if code not in existing:
+        code = _random_code(length)
+        if _reserve_code(code):
             return code
 
 
 
-def _ensure_user_code(users: list[dict], user: dict) -> bool:
+def _ensure_user_code(user: dict) -> bool:
     """Assign a unique immutable code to user if missing. Returns True if modified."""
     if user is None:
         return False
     if user.get('code'):
         return False
-    existing = {u.get('code') for u in users if isinstance(u, dict) and u.get('code')}
-    user['code'] = _generate_unique_code(existing, length=7)
+    user['code'] = _generate_unique_code(length=7)
     return True
 
 
 
+def _index_users(users: list[dict]):
+    USERS_BY_EMAIL.clear()
+    USER_CODES.clear()
+    for u in users:
+        if isinstance(u, dict) and u.get('email'):
+            USERS_BY_EMAIL.setdefault(u['email'], u)
+            if u.get('code'):
+                USER_CODES.add(u['code'])
+    _USERS_INDEX['source'] = users
+    _USERS_INDEX['generation'] += 1
+
+
+def _users_index() -> dict[str, dict]:
+    """Return USERS_BY_EMAIL, re-indexing if data.json changed on disk."""
+    with _FILE_LOCK:
+        users = _read_users_list()
+        if users is not _USERS_INDEX['source']:
+            _index_users(users)
+        return USERS_BY_EMAIL
+
+
 def _backfill_all_codes():
+    if _redis is not None:
+        return
     try:
-        users = _read_users_list()
-        changed = False
-        for u in users:
-            if isinstance(u, dict) and _ensure_user_code(users, u):
-                changed = True
-        if changed:
-            _write_users_list(users)
+        with buffered_users():
+            for u in list(_users_index().values()):
+                if _ensure_user_code(u):
+                    _save_user(u)
     except Exception:
         pass
 
 
+def _migrate_users_to_redis():
+    """One-shot import of data.json into Redis on first startup."""
+    if _redis is None:
+        return
+    try:
+        # One worker migrates at a time; the flag is only set once every user
+        # is copied, so a failed run is retried (already-copied users are skipped)
+        with _redis.lock(USERS_MIGRATED_KEY + ':lock', timeout=300):
+            if _redis.exists(USERS_MIGRATED_KEY):
+                return
+            for u in _read_users_list():
+                if not isinstance(u, dict) or not u.get('email'):
+                    continue
+                if _redis.exists(_user_key(u['email'])):
+                    continue
+                # _save_user adds the code to users:codes together with the user
+                if u.get('code') and _redis.sismember(USER_CODES_KEY, u['code']):
+                    u['code'] = None
+                _ensure_user_code(u)
+                _save_user(u)
+            _redis.set(USERS_MIGRATED_KEY, '1')
+    except Exception:
+        app.logger.exception('Migrating data.json users to Redis failed; will retry on next start')
+
+
+# New passwords are hashed with argon2id. Werkzeug pbkdf2/scrypt hashes from
+# older accounts are still accepted and upgraded on the next successful login.
+_PASSWORD_HASHER = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
+
+
+def _hash_password(password: str) -> str:
+    return _PASSWORD_HASHER.hash(password)
+
+
+def _verify_password(stored: str, password: str) -> tuple[bool, bool]:
+    """Check password against stored hash. Returns (valid, needs_rehash)."""
+    if stored.startswith('$argon2'):
+        try:
+            _PASSWORD_HASHER.verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False, False
+        return True, _PASSWORD_HASHER.check_needs_rehash(stored)
+    # If legacy plaintext was stored, allow login once and upgrade the hash
+    valid = False
+    try:
+        valid = check_password_hash(stored, password)
+    except Exception:
+        valid = (stored == password)
+    return valid, valid
+
+
 # Backfill codes for existing users at startup (one-time, safe)
 _backfill_all_codes()
+_migrate_users_to_redis()
+if _redis is None:
+    threading.Thread(target=_users_flush_worker, name='users-flush', daemon=True).start()
+    atexit.register(_flush_dirty_users)
+
+
+@app.before_request
+def _parse_json_payload():
+    """Parse the JSON body of POST requests once into g.payload.
+
+    Every endpoint reads string fields only, so values are pre-stripped and
+    non-string values are dropped (treated like a missing field).
+    """
+    if request.method != 'POST':
+        return
+    data = request.get_json(silent=True) if request.is_json else None
+    if not isinstance(data, dict):
+        data = {}
+    g.payload = {k: v.strip() for k, v in data.items() if isinstance(v, str)}
 
 
 @app.route('/')
@@ -128,34 +526,33 @@ def api_get_storage():
 
 
 @app.post('/api/storage')
+@buffered_users()
 def api_post_storage():
     try:
-        payload = request.get_json(silent=True) or {}
-        email = (payload.get('email') or '').strip()
-        password = (payload.get('pass') or '').strip()
-        name = (payload.get('name') or '').strip()
+        payload = g.payload
+        email = payload.get('email') or ''
+        password = payload.get('pass') or ''
+        name = payload.get('name') or ''
         if not email or not password:
             return jsonify({"ok": False, "error": "email and pass are required"}), 400
-        users = _read_users_list()
         # Security: do NOT allow overwriting existing accounts here.
         # If email already exists, return conflict. Use a dedicated, verified flow to change passwords.
-        for u in users:
-            if isinstance(u, dict) and u.get('email') == email:
-                return jsonify({"ok": False, "error": "account exists"}), 409
+        if _user_exists(email):
+            return jsonify({"ok": False, "error": "account exists"}), 409
         # Hash password before storing
-        hashed = generate_password_hash(password)
+        hashed = _hash_password(password)
         # Accept optional display name at creation time
-        users.append({
+        user = {
             "email": email,
             "pass": hashed,
             "name": name,
             "email_changed": False,
             "name_changed": False,
             "code": None,
-        })
+        }
         # Assign unique code
-        _ensure_user_code(users, users[-1])
-        _write_users_list(users)
+        _ensure_user_code(user)
+        _save_user(user)
         return jsonify({"ok": True})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 400
@@ -166,35 +563,33 @@ def api_account_exists():
     email = (request.args.get('email') or '').strip()
     if not email:
         return jsonify({"exists": False})
-    users = _read_users_list()
-    exists = _find_user(users, email) is not None
-    return jsonify({"exists": exists})
+    return jsonify({"exists": _user_exists(email)})
 
 
 @app.post('/api/login')
 def api_login():
     try:
-        payload = request.get_json(silent=True) or {}
-        email = (payload.get('email') or '').strip()
-        password = (payload.get('pass') or '').strip()
+        payload = g.payload
+        email = payload.get('email') or ''
+        password = payload.get('pass') or ''
         if not email or not password:
             return jsonify({"ok": False}), 400
-        users = _read_users_list()
-        u = _find_user(users, email)
+        u = _find_user(email)
         if not u:
             return jsonify({"ok": False}), 401
         # Backfill immutable code if missing
-        if _ensure_user_code(users, u):
-            _write_users_list(users)
-        stored = u.get('pass') or ''
-        # If legacy plaintext was stored, allow one-time login then upgrade on reset/change
-        valid = False
-        try:
-            valid = check_password_hash(stored, password)
-        except Exception:
-            valid = (stored == password)
+        if _ensure_user_code(u):
+            _save_user_later(u)
+        stored = u.get('pass')
+        # Google-created accounts have no password until one is set via reset
+        if not stored:
+            return jsonify({"ok": False}), 401
+        valid, needs_rehash = _verify_password(stored, password)
         if not valid:
             return jsonify({"ok": False}), 401
+        if needs_rehash:
+            u['pass'] = _hash_password(password)
+            _save_user_later(u)
         # Establish server-side session
         session['user_email'] = email
         return jsonify({"ok": True})
@@ -202,7 +597,11 @@ def api_login():
         return jsonify({"ok": False}), 400
 
 
-# In-memory code store and verification tokens (single-process dev use)
+# Short-lived codes and verification tokens. With Redis these are keys with a
+# native TTL ("code:<email>", "token:<email>", "pending_email:<email>");
+# otherwise they fall back to these in-memory dicts (single-process dev use).
+# Fallback expiry is tracked in one min-heap of (exp, kind, key) shared by all
+# three dicts, so purging only looks at entries that are actually due.
 CODE_STORE: dict[str, dict] = {}
 VERIFIED_TOKENS: dict[str, dict] = {}
 CODE_TTL_SECONDS = 5 * 60
@@ -211,26 +610,85 @@ TOKEN_TTL_SECONDS = 5 * 60
 # Pending email change store: keyed by current session email
 PENDING_EMAIL_CHANGES: dict[str, dict] = {}
 
+_TTL_STORES = {
+    'code': CODE_STORE,
+    'token': VERIFIED_TOKENS,
+    'pending_email': PENDING_EMAIL_CHANGES,
+}
+_EXP_HEAP: list[tuple[float, str, str]] = []
+_TTL_LOCK = threading.Lock()
+
 
 def _purge_expired():
     now = time.time()
-    for d in (CODE_STORE, VERIFIED_TOKENS):
-        for k in list(d.keys()):
-            if d[k].get('exp', 0) < now:
-                del d[k]
+    with _TTL_LOCK:
+        while _EXP_HEAP and _EXP_HEAP[0][0] < now:
+            _, kind, key = heapq.heappop(_EXP_HEAP)
+            store = _TTL_STORES[kind]
+            entry = store.get(key)
+            # The key may have been re-set with a later expiry since this push
+            if entry is not None and entry['exp'] < now:
+                del store[key]
+
+
+def _ttl_set(kind: str, key: str, value: str, ttl: int):
+    if _redis is not None:
+        _redis.setex(f'{kind}:{key}', ttl, value)
+        return
+    _purge_expired()
+    exp = time.time() + ttl
+    with _TTL_LOCK:
+        _TTL_STORES[kind][key] = {"value": value, "exp": exp}
+        heapq.heappush(_EXP_HEAP, (exp, kind, key))
+
+
+def _ttl_get(kind: str, key: str) -> Optional[str]:
+    if _redis is not None:
+        return _redis.get(f'{kind}:{key}')
+    _purge_expired()
+    store = _TTL_STORES[kind]
+    entry = store.get(key)
+    if entry is None:
+        return None
+    if entry['exp'] < time.time():
+        store.pop(key, None)
+        return None
+    return entry['value']
+
+
+# Compare-and-delete in one step, so a code or token can only be used once
+# even when two requests present it at the same time
+_CONSUME_SCRIPT = _redis.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""") if _redis is not None else None
+
+
+def _ttl_consume(kind: str, key: str, expected: str) -> bool:
+    """Delete the entry if it holds expected. Returns True if it did."""
+    if _redis is not None:
+        return bool(_CONSUME_SCRIPT(keys=[f'{kind}:{key}'], args=[expected]))
+    store = _TTL_STORES[kind]
+    with _TTL_LOCK:
+        entry = store.get(key)
+        if entry is None or entry['exp'] < time.time() or entry['value'] != expected:
+            return False
+        del store[key]
+        return True
 
 
 @app.post('/api/request_code')
 def api_request_code():
     # Client supplies a code that will be emailed via EmailJS from the frontend.
     try:
-        data = request.get_json(silent=True) or {}
-        email = (data.get('email') or '').strip()
-        code = (data.get('code') or '').strip()
+        data = g.payload
+        email = data.get('email') or ''
+        code = data.get('code') or ''
         if not email or not code or len(code) != 6 or not code.isdigit():
             return jsonify({"ok": False}), 400
-        _purge_expired()
-        CODE_STORE[email] = {"code": code, "exp": time.time() + CODE_TTL_SECONDS}
+        _ttl_set('code', email, code, CODE_TTL_SECONDS)
         return jsonify({"ok": True})
     except Exception:
         return jsonify({"ok": False}), 400
@@ -239,27 +697,21 @@ def api_request_code():
 @app.post('/api/verify_code')
 def api_verify_code():
     try:
-        data = request.get_json(silent=True) or {}
-        email = (data.get('email') or '').strip()
-        code = (data.get('code') or '').strip()
+        data = g.payload
+        email = data.get('email') or ''
+        code = data.get('code') or ''
         if not email or not code:
             return jsonify({"ok": False}), 400
-        _purge_expired()
-        entry = CODE_STORE.get(email)
-        if not entry or entry.get('code') != code or entry.get('exp', 0) < time.time():
+        # Remove used code; a wrong guess leaves the stored code in place
+        if not _ttl_consume('code', email, code):
             return jsonify({"ok": False}), 400
         # Issue short-lived token and establish authenticated session
         token = secrets.token_urlsafe(24)
-        VERIFIED_TOKENS[email] = {"token": token, "exp": time.time() + TOKEN_TTL_SECONDS}
+        _ttl_set('token', email, token, TOKEN_TTL_SECONDS)
         try:
             session['user_email'] = email
         except Exception:
             pass
-        # Remove used code
-        try:
-            del CODE_STORE[email]
-        except Exception:
-            pass
         return jsonify({"ok": True, "token": token})
     except Exception:
         return jsonify({"ok": False}), 400
@@ -268,27 +720,20 @@ def api_verify_code():
 @app.post('/api/reset_password')
 def api_reset_password():
     try:
-        data = request.get_json(silent=True) or {}
-        email = (data.get('email') or '').strip()
-        new_pass = (data.get('new_pass') or '').strip()
-        token = (data.get('token') or '').strip()
+        data = g.payload
+        email = data.get('email') or ''
+        new_pass = data.get('new_pass') or ''
+        token = data.get('token') or ''
         if not email or not new_pass or not token:
             return jsonify({"ok": False}), 400
-        _purge_expired()
-        v = VERIFIED_TOKENS.get(email)
-        if not v or v.get('token') != token or v.get('exp', 0) < time.time():
+        # Invalidate token
+        if not _ttl_consume('token', email, token):
             return jsonify({"ok": False}), 400
-        users = _read_users_list()
-        u = _find_user(users, email)
+        u = _find_user(email)
         if not u:
             return jsonify({"ok": False}), 404
-        u['pass'] = generate_password_hash(new_pass)
-        _write_users_list(users)
-        # Invalidate token
-        try:
-            del VERIFIED_TOKENS[email]
-        except Exception:
-            pass
+        u['pass'] = _hash_password(new_pass)
+        _save_user(u)
         return jsonify({"ok": True})
     except Exception:
         return jsonify({"ok": False}), 400
@@ -303,62 +748,55 @@ def api_request_email_change():
         current_email = session.get('user_email')
         if not current_email:
             return jsonify({"ok": False}), 401
-        data = request.get_json(silent=True) or {}
-        new_email = (data.get('new_email') or '').strip()
-        code = (data.get('code') or '').strip()
+        data = g.payload
+        new_email = data.get('new_email') or ''
+        code = data.get('code') or ''
         if not new_email or not code or len(code) != 6 or not code.isdigit():
             return jsonify({"ok": False, "error": "invalid input"}), 400
         # Ensure new email is not already in use
-        users = _read_users_list()
-        if _find_user(users, new_email):
+        if _user_exists(new_email):
             return jsonify({"ok": False, "error": "email exists"}), 409
-        _purge_expired()
-        PENDING_EMAIL_CHANGES[current_email] = {
-            "new_email": new_email,
-            "code": code,
-            "exp": time.time() + CODE_TTL_SECONDS,
-        }
+        _ttl_set('pending_email', current_email,
+                 json.dumps({"new_email": new_email, "code": code}), CODE_TTL_SECONDS)
         return jsonify({"ok": True})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 400
 
 
 @app.post('/api/confirm_email_change')
+@buffered_users()
 def api_confirm_email_change():
     """Confirm email change with the code that was sent to the new email address."""
     try:
         current_email = session.get('user_email')
         if not current_email:
             return jsonify({"ok": False}), 401
-        data = request.get_json(silent=True) or {}
-        new_email = (data.get('new_email') or '').strip()
-        code = (data.get('code') or '').strip()
+        data = g.payload
+        new_email = data.get('new_email') or ''
+        code = data.get('code') or ''
         if not new_email or not code:
             return jsonify({"ok": False}), 400
-        _purge_expired()
-        entry = PENDING_EMAIL_CHANGES.get(current_email)
-        if (not entry or entry.get('new_email') != new_email or
-                entry.get('code') != code or entry.get('exp', 0) < time.time()):
+        raw = _ttl_get('pending_email', current_email)
+        entry = json.loads(raw) if raw else None
+        if not entry or entry.get('new_email') != new_email or entry.get('code') != code:
             return jsonify({"ok": False, "error": "invalid_or_expired"}), 400
 
-        users = _read_users_list()
+        user, existing = _find_users(current_email, new_email)
         # Prevent collision
-        if _find_user(users, new_email):
+        if existing:
             return jsonify({"ok": False, "error": "email exists"}), 409
-        user = _find_user(users, current_email)
         if not user:
             return jsonify({"ok": False}), 404
+        # Claim the pending change; fails if a concurrent confirm got there first
+        if not _ttl_consume('pending_email', current_email, raw):
+            return jsonify({"ok": False, "error": "invalid_or_expired"}), 400
         # Update email and flags
         user['email'] = new_email
         user.setdefault('email_changed', False)
         user['email_changed'] = True
-        _write_users_list(users)
-        # Update session and cleanup
+        _save_user(user, old_email=current_email)
+        # Update session
         session['user_email'] = new_email
-        try:
-            del PENDING_EMAIL_CHANGES[current_email]
-        except Exception:
-            pass
         return jsonify({"ok": True})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 400
@@ -373,32 +811,41 @@ def api_logout():
         return jsonify({"ok": False}), 400
 
 
+@lru_cache(maxsize=1024)
+def _me_shape(email: str, users_version: int) -> tuple[bytes, bool]:
+    """Serialized /api/me body, and whether the user still lacks a code.
+
+    users_version keys out entries after any user change.
+    """
+    # Backfill defaults for legacy entries
+    u = _find_user(email) or {}
+    body = orjson.dumps({
+        "ok": True,
+        "email": email,
+        "name": u.get('name') or '',
+        "email_changed": bool(u.get('email_changed')),
+        "name_changed": bool(u.get('name_changed')),
+        "code": u.get('code') or '',
+    })
+    return body, bool(u) and not u.get('code')
+
+
 @app.get('/api/me')
 def api_me():
     try:
         email = session.get('user_email')
         if not email:
             return jsonify({"ok": False}), 401
-        users = _read_users_list()
-        u = _find_user(users, email)
-        # Backfill defaults for legacy entries
-        name = (u or {}).get('name') or ''
-        email_changed = bool((u or {}).get('email_changed'))
-        name_changed = bool((u or {}).get('name_changed'))
-        # Backfill code if missing
-        modified = False
-        if u and _ensure_user_code(users, u):
-            modified = True
-        if modified:
-            _write_users_list(users)
-        return jsonify({
-            "ok": True,
-            "email": email,
-            "name": name,
-            "email_changed": email_changed,
-            "name_changed": name_changed,
-            "code": (u or {}).get('code') or '',
-        })
+        # A cache hit costs one version read; the user is only looked up on a miss
+        body, missing_code = _me_shape(email, _users_version())
+        if missing_code:
+            # Backfill code if missing (legacy file entries; Redis users always
+            # have one), then rebuild the body under the new version
+            u = _find_user(email)
+            if u and _ensure_user_code(u):
+                _save_user_later(u)
+            body, _ = _me_shape(email, _users_version())
+        return Response(body, mimetype='application/json')
     except Exception:
         return jsonify({"ok": False}), 400
 
@@ -410,14 +857,17 @@ def api_update_profile():
         current_email = session.get('user_email')
         if not current_email:
             return jsonify({"ok": False}), 401
-        payload = request.get_json(silent=True) or {}
-        field = (payload.get('field') or '').strip()
-        value = (payload.get('value') or '').strip()
+        payload = g.payload
+        field = payload.get('field') or ''
+        value = payload.get('value') or ''
         if field not in ('email', 'name') or not value:
             return jsonify({"ok": False, "error": "invalid input"}), 400
 
-        users = _read_users_list()
-        user = _find_user(users, current_email)
+        # value is only an email (and worth looking up) for email changes
+        if field == 'email':
+            user, existing = _find_users(current_email, value)
+        else:
+            user, existing = _find_user(current_email), None
         if not user:
             return jsonify({"ok": False}), 404
 
@@ -430,7 +880,7 @@ def api_update_profile():
             if user.get('email_changed'):
                 return jsonify({"ok": False, "error": "email already changed"}), 403
             # Ensure unique email
-            if _find_user(users, value) and value != current_email:
+            if existing and value != current_email:
                 return jsonify({"ok": False, "error": "email exists"}), 409
             user['email'] = value
             user['email_changed'] = True
@@ -443,7 +893,7 @@ def api_update_profile():
             user['name'] = value
             user['name_changed'] = True
 
-        _write_users_list(users)
+        _save_user(user, old_email=current_email)
         return jsonify({"ok": True})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 400
@@ -453,17 +903,23 @@ def api_update_profile():
 @app.post('/api/login_google')
 def api_login_google():
     try:
-        data = request.get_json(silent=True) or {}
-        email = (data.get('email') or '').strip()
+        data = g.payload
+        email = data.get('email') or ''
         if not email:
             return jsonify({"ok": False}), 400
-        users = _read_users_list()
-        u = _find_user(users, email)
-        if not u:
-            # Create a new user with a random password
-            rand_pass = secrets.token_urlsafe(12)
-            users.append({"email": email, "pass": generate_password_hash(rand_pass)})
-            _write_users_list(users)
+        if not _user_exists(email):
+            # No password for Google accounts: hashing one nobody knows is wasted work
+            user = {
+                "email": email,
+                "pass": None,
+                "google": True,
+                "name": "",
+                "email_changed": False,
+                "name_changed": False,
+                "code": None,
+            }
+            _ensure_user_code(user)
+            _save_user(user)
         session['user_email'] = email
         return jsonify({"ok": True})
     except Exception:
@@ -476,28 +932,191 @@ PRODUCTS_FILE = os.path.join(BASE_DIR, 'products.json')
 
 def _read_products_list() -> list[dict]:
     """Read products from JSON file"""
-    try:
-        if not os.path.exists(PRODUCTS_FILE) or os.path.getsize(PRODUCTS_FILE) == 0:
-            return []
-        with open(PRODUCTS_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data if isinstance(data, list) else []
-    except Exception:
-        return []
+    return _read_json_list(PRODUCTS_FILE)
 
 
 def _write_products_list(products: list[dict]):
     """Write products to JSON file"""
-    with open(PRODUCTS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(products, f, ensure_ascii=False, indent=2)
+    _write_json_list(PRODUCTS_FILE, products)
 
 
-def _find_product(products: list[dict], product_id: str) -> Optional[dict]:
-    """Find product by ID"""
+def buffered_products():
+    """Defer products.json writes until the block (or decorated view) exits."""
+    return _buffered_writes(PRODUCTS_FILE)
+
+
+# Deletes are appended to a log (one product id per line) instead of
+# rewriting products.json; compaction folds the log into products.json at
+# startup and once _COMPACT_AFTER_DELETES ids have built up.
+PRODUCTS_DELETE_LOG = os.path.join(BASE_DIR, 'products.deleted.log')
+# Compaction first moves the log here, so deletes appended meanwhile (by any
+# worker) land in a fresh log and are never removed with the compacted ids
+_COMPACTING_LOG = PRODUCTS_DELETE_LOG + '.compacting'
+_COMPACT_AFTER_DELETES = 64
+# Parsed delete logs, cached by stat keys like _JSON_CACHE
+_DELETED_IDS = {"stat": None, "ids": set()}
+
+
+def _deleted_ids_key() -> tuple:
+    return _stat_key(PRODUCTS_DELETE_LOG), _stat_key(_COMPACTING_LOG)
+
+
+def _read_id_file(path: str) -> set[str]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return {line.strip() for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def _read_deleted_ids() -> set[str]:
+    """Ids in the delete log and in a compaction still in progress."""
+    with _FILE_LOCK:
+        key = _deleted_ids_key()
+        if key == _DELETED_IDS['stat']:
+            return _DELETED_IDS['ids']
+        try:
+            ids = _read_id_file(PRODUCTS_DELETE_LOG) | _read_id_file(_COMPACTING_LOG)
+        except OSError:
+            return _DELETED_IDS['ids']
+        _DELETED_IDS['stat'] = key
+        _DELETED_IDS['ids'] = ids
+        return ids
+
+
+def _append_deleted_id(product_id: str):
+    with _FILE_LOCK:
+        ids = _read_deleted_ids()
+        with open(PRODUCTS_DELETE_LOG, 'a', encoding='utf-8') as f:
+            f.write(product_id + '\n')
+        ids.add(product_id)
+        _DELETED_IDS['stat'] = _deleted_ids_key()
+
+
+# products.json indexes, rebuilt whenever the parsed file or delete log changes
+PRODUCTS_BY_ID: dict[str, dict] = {}
+PRODUCTS_BY_CATSUB: dict[tuple[str, str], list[dict]] = defaultdict(list)
+_PRODUCTS_INDEX = {"source": None, "deleted": None}
+
+
+def _product_cat_sub(product: dict) -> tuple[str, str]:
+    return (product.get('catTitle') or '').strip(), (product.get('subTitle') or '').strip()
+
+
+def _index_products(products: list[dict], deleted: set[str]):
+    PRODUCTS_BY_ID.clear()
+    PRODUCTS_BY_CATSUB.clear()
     for p in products:
-        if isinstance(p, dict) and p.get('id') == product_id:
-            return p
-    return None
+        if not isinstance(p, dict) or not p.get('id'):
+            continue
+        if p['id'] not in deleted and p['id'] not in PRODUCTS_BY_ID:
+            PRODUCTS_BY_ID[p['id']] = p
+            PRODUCTS_BY_CATSUB[_product_cat_sub(p)].append(p)
+    _PRODUCTS_INDEX['source'] = products
+    _PRODUCTS_INDEX['deleted'] = deleted
+
+
+def _products_index() -> dict[str, dict]:
+    """Return PRODUCTS_BY_ID, re-indexing if products.json or the delete log changed."""
+    with _FILE_LOCK:
+        products = _read_products_list()
+        deleted = _read_deleted_ids()
+        if products is not _PRODUCTS_INDEX['source'] or deleted is not _PRODUCTS_INDEX['deleted']:
+            _index_products(products, deleted)
+        return PRODUCTS_BY_ID
+
+
+def _find_product(product_id: str) -> Optional[dict]:
+    """Find product by ID"""
+    with _FILE_LOCK:
+        return _products_index().get(product_id)
+
+
+def _add_product(product: dict):
+    with _FILE_LOCK:
+        _products_index()
+        PRODUCTS_BY_ID[product['id']] = product
+        PRODUCTS_BY_CATSUB[_product_cat_sub(product)].append(product)
+        products = _PRODUCTS_INDEX['source']
+        products.append(product)
+        _write_products_list(products)
+
+
+def _remove_product(product: dict):
+    """Log a delete (one appended line); compact once enough have piled up."""
+    with _FILE_LOCK:
+        PRODUCTS_BY_ID.pop(product['id'], None)
+        bucket = PRODUCTS_BY_CATSUB.get(_product_cat_sub(product))
+        if bucket is not None:
+            bucket[:] = [p for p in bucket if p is not product]
+        _append_deleted_id(product['id'])
+        if len(_read_deleted_ids()) >= _COMPACT_AFTER_DELETES:
+            _compact_products()
+
+
+def _compact_products():
+    """Rewrite products.json without the logged deletes, then clear the log."""
+    with _FILE_LOCK:
+        if not _read_deleted_ids():
+            return
+        # A snapshot left by an interrupted compaction is folded in first; the
+        # live log is then picked up by the next compaction
+        if not os.path.exists(_COMPACTING_LOG):
+            try:
+                os.replace(PRODUCTS_DELETE_LOG, _COMPACTING_LOG)
+            except FileNotFoundError:
+                return
+        ids = _read_id_file(_COMPACTING_LOG)
+        products = [p for p in _read_products_list()
+                    if not (isinstance(p, dict) and p.get('id') in ids)]
+        # products.json first: until the snapshot is removed its ids still
+        # count as deleted, so stopping in between is harmless
+        _write_products_list(products)
+        try:
+            os.remove(_COMPACTING_LOG)
+        except FileNotFoundError:
+            # Another worker finished the same snapshot
+            pass
+
+
+# Fields the frontend expects on every product; api_create_product always sets them
+_PRODUCT_DEFAULTS = {
+    'id': '',
+    'name': '',
+    'desc': '',
+    'priceLabel': '',
+    'contact': '',
+    'image': '',
+    'sellerName': 'مستخدم',
+    'sellerCode': '',
+    'sellerEmail': '',
+}
+
+
+def _backfill_product_fields():
+    try:
+        products = _read_products_list()
+        now = int(time.time())
+        changed = False
+        for p in products:
+            if not isinstance(p, dict):
+                continue
+            for k, v in _PRODUCT_DEFAULTS.items():
+                if k not in p:
+                    p[k] = v
+                    changed = True
+            if 'created_at' not in p:
+                p['created_at'] = now
+                changed = True
+        if changed:
+            _write_products_list(products)
+    except Exception:
+        pass
+
+
+# Backfill required fields for legacy products and apply logged deletes at startup
+_backfill_product_fields()
+_compact_products()
 
 
 @app.get('/api/products')
@@ -507,48 +1126,32 @@ def api_get_products():
         cat = request.args.get('cat', '').strip()
         sub = request.args.get('sub', '').strip()
         
-        products = _read_products_list()
+        products_by_id = _products_index()
         
         # Filter by category and subcategory if provided
-        if cat or sub:
-            filtered = []
-            for p in products:
-                if isinstance(p, dict):
-                    p_cat = p.get('catTitle', '').strip()
-                    p_sub = p.get('subTitle', '').strip()
-                    
-                    cat_match = not cat or p_cat == cat
-                    sub_match = not sub or p_sub == sub
-                    
-                    if cat_match and sub_match:
-                        filtered.append(p)
-            products = filtered
+        if cat and sub:
+            products = PRODUCTS_BY_CATSUB.get((cat, sub), [])
+        elif cat or sub:
+            products = []
+            for p in products_by_id.values():
+                p_cat, p_sub = _product_cat_sub(p)
+                if (not cat or p_cat == cat) and (not sub or p_sub == sub):
+                    products.append(p)
+        else:
+            products = products_by_id.values()
         
-        # Add computed fields for frontend
-        for p in products:
-            if isinstance(p, dict):
-                # Add canDelete flag (user can delete their own products)
-                current_email = session.get('user_email', '')
-                p['canDelete'] = p.get('sellerEmail') == current_email
-                
-                # Ensure required fields exist
-                p.setdefault('id', '')
-                p.setdefault('name', '')
-                p.setdefault('desc', '')
-                p.setdefault('priceLabel', '')
-                p.setdefault('contact', '')
-                p.setdefault('image', '')
-                p.setdefault('sellerName', 'مستخدم')
-                p.setdefault('sellerCode', '')
-                p.setdefault('sellerEmail', '')
-                p.setdefault('created_at', int(time.time()))
+        # Add canDelete flag (user can delete their own products), on copies
+        # since the parsed list is cached
+        current_email = session.get('user_email', '')
+        items = [{**p, 'canDelete': p.get('sellerEmail') == current_email} for p in products]
         
-        return jsonify({"ok": True, "items": products})
+        return jsonify({"ok": True, "items": items})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 400
 
 
 @app.post('/api/products')
+@buffered_products()
 def api_create_product():
     """Create a new product"""
     try:
@@ -556,21 +1159,20 @@ def api_create_product():
         if not current_email:
             return jsonify({"ok": False, "error": "not authenticated"}), 401
             
-        data = request.get_json(silent=True) or {}
-        name = (data.get('name') or '').strip()
-        cat_title = (data.get('catTitle') or '').strip()
-        sub_title = (data.get('subTitle') or '').strip()
-        desc = (data.get('desc') or '').strip()
-        contact = (data.get('contact') or '').strip()
-        price_label = (data.get('priceLabel') or '').strip()
-        image = (data.get('image') or '').strip()
+        data = g.payload
+        name = data.get('name') or ''
+        cat_title = data.get('catTitle') or ''
+        sub_title = data.get('subTitle') or ''
+        desc = data.get('desc') or ''
+        contact = data.get('contact') or ''
+        price_label = data.get('priceLabel') or ''
+        image = data.get('image') or ''
         
         if not name:
             return jsonify({"ok": False, "error": "product name is required"}), 400
             
         # Get seller info from current user
-        users = _read_users_list()
-        user = _find_user(users, current_email)
+        user = _find_user(current_email)
         seller_name = 'مستخدم'
         seller_code = ''
         if user:
@@ -594,9 +1196,7 @@ def api_create_product():
             "created_at": int(time.time())
         }
         
-        products = _read_products_list()
-        products.append(product)
-        _write_products_list(products)
+        _add_product(product)
         
         return jsonify({"ok": True, "id": product_id})
     except Exception as e:
@@ -607,13 +1207,13 @@ def api_create_product():
 def api_get_product(product_id: str):
     """Get a specific product by ID"""
     try:
-        products = _read_products_list()
-        product = _find_product(products, product_id)
+        product = _find_product(product_id)
         
         if not product:
             return jsonify({"ok": False, "error": "product not found"}), 404
             
-        # Add computed fields
+        # Add computed fields (on a copy, the parsed list is cached)
+        product = dict(product)
         current_email = session.get('user_email', '')
         product['canDelete'] = product.get('sellerEmail') == current_email
         
@@ -630,8 +1230,7 @@ def api_delete_product(product_id: str):
         if not current_email:
             return jsonify({"ok": False, "error": "not authenticated"}), 401
             
-        products = _read_products_list()
-        product = _find_product(products, product_id)
+        product = _find_product(product_id)
         
         if not product:
             return jsonify({"ok": False, "error": "product not found"}), 404
@@ -641,8 +1240,7 @@ def api_delete_product(product_id: str):
             return jsonify({"ok": False, "error": "not authorized"}), 403
             
         # Remove product
-        products = [p for p in products if p.get('id') != product_id]
-        _write_products_list(products)
+        _remove_product(product)
         
         return jsonify({"ok": True})
     except Exception as e:
@@ -0,0 +1,192 @@
+import os
+import sys
+import threading
+import time
+
+import orjson
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.pop('REDIS_URL', None)
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def users_file(tmp_path, monkeypatch):
+    path = str(tmp_path / 'data.json')
+    monkeypatch.setattr(app, 'DATA_FILE', path)
+    app._USERS_INDEX['source'] = None
+    yield path
+    app._JSON_CACHE.pop(path, None)
+    # Make the next caller re-index from the real data.json
+    app._USERS_INDEX['source'] = None
+
+
+def _seed_users(count: int):
+    users = [{"email": f"u{i}@x.com", "pass": "x", "code": f"C{i:06d}"} for i in range(count)]
+    app._write_users_list(users)
+    app._USERS_INDEX['source'] = None
+    assert len(app._users_index()) == count
+
+
+def test_reads_during_flush_do_not_lose_users(users_file):
+    _seed_users(3000)
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            app._find_user('u1@x.com')
+            time.sleep(0.0001)
+
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+    for t in readers:
+        t.start()
+    try:
+        for _ in range(40):
+            app._flush_users()
+            time.sleep(0.01)
+    finally:
+        stop.set()
+        for t in readers:
+            t.join()
+
+    assert len(app._users_index()) == 3000
+    with open(users_file, 'rb') as f:
+        assert len(orjson.loads(f.read())) == 3000
+
+
+def test_unparsable_file_keeps_last_good_data(users_file):
+    _seed_users(3)
+    with open(users_file, 'wb') as f:
+        f.write(b'[{"email": ')
+    assert len(app._read_users_list()) == 3
+    assert app._find_user('u2@x.com') is not None
+
+
+def test_buffered_write_over_unparsable_file(users_file):
+    with open(users_file, 'wb') as f:
+        f.write(b'[{"email": ')
+    with app.buffered_users():
+        app._save_user({"email": "new@x.com", "pass": "x", "code": "Znewcod"})
+        assert app._user_exists('new@x.com')
+    with open(users_file, 'rb') as f:
+        assert [u['email'] for u in orjson.loads(f.read())] == ['new@x.com']
+
+
+def test_buffered_writes_are_scoped_to_their_thread(users_file):
+    _seed_users(1)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def buffered_request():
+        with app.buffered_users():
+            entered.set()
+            release.wait(5)
+
+    t = threading.Thread(target=buffered_request)
+    t.start()
+    try:
+        entered.wait(5)
+        # Another thread's write is not held back by the open buffer
+        app._save_user({"email": "new@x.com", "pass": "x", "code": "Znewcod"})
+        with open(users_file, 'rb') as f:
+            assert any(u['email'] == 'new@x.com' for u in orjson.loads(f.read()))
+    finally:
+        release.set()
+        t.join()
+
+
+def test_buffered_writes_from_many_threads_leave_no_residue(users_file):
+    _seed_users(1)
+
+    def worker():
+        for _ in range(200):
+            with app.buffered_users():
+                pass
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    app._save_user({"email": "after@x.com", "pass": "x", "code": "Zafterc"})
+    with open(users_file, 'rb') as f:
+        assert any(u['email'] == 'after@x.com' for u in orjson.loads(f.read()))
+
+
+def test_buffered_writes_are_written_once_on_exit(users_file):
+    _seed_users(1)
+    with app.buffered_users():
+        app._save_user({"email": "a@x.com", "pass": "x", "code": "Zaaaaaa"})
+        app._save_user({"email": "b@x.com", "pass": "x", "code": "Zbbbbbb"})
+        assert app._find_user('b@x.com') is not None
+        with open(users_file, 'rb') as f:
+            assert len(orjson.loads(f.read())) == 1
+    with open(users_file, 'rb') as f:
+        assert len(orjson.loads(f.read())) == 3
+
+
+def test_saves_during_flush_are_kept(users_file):
+    _seed_users(2300)
+    stop = threading.Event()
+
+    def signups():
+        for i in range(500):
+            # Same calls as the signup endpoint: existence check, then save
+            assert not app._user_exists(f"new{i}@x.com")
+            app._save_user({"email": f"new{i}@x.com", "pass": "x", "code": f"N{i:06d}"})
+        stop.set()
+
+    def backfills():
+        i = 0
+        while not stop.is_set():
+            app._save_user_later({"email": f"u{i % 2300}@x.com", "pass": "x", "code": f"C{i % 2300:06d}"})
+            i += 1
+
+    threads = [threading.Thread(target=signups), threading.Thread(target=backfills)]
+    for t in threads:
+        t.start()
+    while not stop.is_set():
+        app._USERS_DIRTY.set()
+        app._flush_dirty_users()
+    for t in threads:
+        t.join()
+    app._flush_dirty_users()
+
+    assert len(app._users_index()) == 2800
+    with open(users_file, 'rb') as f:
+        assert len(orjson.loads(f.read())) == 2800
+
+
+@pytest.fixture
+def products_file(tmp_path, monkeypatch):
+    path = str(tmp_path / 'products.json')
+    log = str(tmp_path / 'products.deleted.log')
+    monkeypatch.setattr(app, 'PRODUCTS_FILE', path)
+    monkeypatch.setattr(app, 'PRODUCTS_DELETE_LOG', log)
+    monkeypatch.setattr(app, '_COMPACTING_LOG', log + '.compacting')
+    monkeypatch.setattr(app, '_DELETED_IDS', {"stat": None, "ids": set()})
+    app._PRODUCTS_INDEX['source'] = None
+    yield path
+    app._JSON_CACHE.pop(path, None)
+    app._PRODUCTS_INDEX['source'] = None
+
+
+def test_delete_logged_during_compaction_is_kept(products_file, monkeypatch):
+    app._write_products_list([{"id": f"p{i}"} for i in range(3)])
+    app._remove_product(app._find_product('p0'))
+    write = app._write_products_list
+
+    def write_while_other_worker_deletes(products):
+        # Another worker appends to the log while this one compacts
+        with open(app.PRODUCTS_DELETE_LOG, 'a', encoding='utf-8') as f:
+            f.write('p1\n')
+        write(products)
+
+    monkeypatch.setattr(app, '_write_products_list', write_while_other_worker_deletes)
+    app._compact_products()
+
+    assert sorted(app._products_index()) == ['p2']
+    with open(products_file, 'rb') as f:
+        assert [p['id'] for p in orjson.loads(f.read())] == ['p1', 'p2']